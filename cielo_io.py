@@ -3,17 +3,23 @@
 Everything outside of here should be relatively platform-agnostic - only this module
 cares that we're on a Raspberry Pi and what the IO setup is.
 
-Interface to this module is a singleton class, Interface. Key methods:
+Interface to this module is a single instance of class Interface, from get_interface().
+Key methods:
     Interface.get_latest_times() # To check latest times of beam crosses or contact
-    Interface.set_on_for(LED, sec)  # Non-blocking, parallel thread turns off)
+    Interface.set_on_for(LED, sec)  # Non-blocking, timer thread turns off
+    Interface.set_on(LED) / set_off(LED)  # For callers keeping their own time
+
+Times are all from time.monotonic(), see to_epoch() to convert.
+
+To wait on inputs rather than poll, register Interface.event_fileno() with select.epoll
+(or similar) - it becomes readable on each input event, until Interface.clear_events().
 """
 import logging
-import sys
+import os
 import threading
 import time
-from dataclasses import dataclass
 from enum import Enum
-from typing import ClassVar, Final, Optional, Set
+from typing import Dict, Final, NamedTuple, Optional
 
 import RPi.GPIO as GPIO
 
@@ -31,12 +37,15 @@ _LOWER_BEAM_SENSOR_INPUT_PIN: Final = 4
 # Pin 19 per same page has a pull-down, also set in code here but PD by default
 _TOUCH_SENSOR_INPUT_PIN: Final = 19
 
-_DEBOUNCE_MILLISECS: Final = 1000  # Not expecting multiple throw events sub-second
+# Debounce is done in the callbacks rather than via RPi.GPIO's bouncetime, which
+# can still double-trigger on noisy edges. Edges within this long of the last
+# accepted one on the same input are ignored.
+_DEBOUNCE_S: Final = 1.0  # Not expecting multiple throw events sub-second
 
-_PAR_THREAD_UPKEEP_PERIOD_S: Final = 0.3
+_log = logging.getLogger(__name__)
 
 # Mods to state and/or initialization go in here to avoid race conditions where
-# setpoint might end up not matching output state, or other issues
+# timers might end up not matching output state, or other issues
 _io_mod_lock = threading.Lock()
 
 
@@ -53,11 +62,11 @@ _ON: Final = 1
 _OFF: Final = 0
 
 
-@dataclass
-class LatestTimes:
+class LatestTimes(NamedTuple):
     """The last times at which each thing happened to beam or hit sensors.
 
-    Times are all float seconds since epoch.
+    Times are all float seconds from time.monotonic() - use to_epoch() to get
+    seconds since epoch (e.g. for storing).
 
     This does NOT include logic like 'yes crossed beams but then you hit,
     so the end result is just a hit (bad)' - it just gives raw latest times.
@@ -67,7 +76,7 @@ class LatestTimes:
     upper_beam_cross: Optional[float] = None
 
 
-# Time that the module has last been touched by ball
+# Monotonic times - time that the module has last been touched by ball
 _T_OF_LAST_HIT: Optional[float] = None
 # Time of last beam interrupt of lower down beam
 _T_OF_LAST_LOWER_BEAM_CROSS: Optional[float] = None
@@ -75,103 +84,137 @@ _T_OF_LAST_LOWER_BEAM_CROSS: Optional[float] = None
 _T_OF_LAST_UPPER_BEAM_CROSS: Optional[float] = None
 
 
+def to_epoch(t_monotonic: float) -> float:
+    """Convert a time from time.monotonic() to float seconds since epoch.
+
+    Callbacks stamp events with time.monotonic(), and only get converted as needed.
+    The offset between the clocks is taken at conversion, not once up front, since
+    the epoch clock may be stepped (e.g. NTP syncing after the Pi boots).
+    """
+    return time.time() - (time.monotonic() - t_monotonic)
+
+
+# Each callback also signals this, so that consumers can block until something happens
+_EVENT_FD: Final = os.eventfd(0, os.EFD_NONBLOCK)
+
+# Count of input events so far, so consumers can cheaply tell if anything is new.
+# Only modified by the callbacks, which RPi.GPIO runs in one thread.
+_EVENT_SEQ = 0
+
+
+def _signal_event() -> None:
+    """Signal consumers that an input event happened (see above)."""
+    global _EVENT_SEQ
+    _EVENT_SEQ += 1
+    os.eventfd_write(_EVENT_FD, 1)
+
+
 # Interrupt callback functions - each one is only modifier of above globals
 
 def _broken_upper_beam_callback(channel) -> None:
-    print("Broke upper beam!")
     global _T_OF_LAST_UPPER_BEAM_CROSS
-    _T_OF_LAST_UPPER_BEAM_CROSS = time.time()
+    t_now = time.monotonic()
+    if _T_OF_LAST_UPPER_BEAM_CROSS is not None and t_now - _T_OF_LAST_UPPER_BEAM_CROSS < _DEBOUNCE_S:
+        return  # Bounce
+    _log.debug("Broke upper beam!")
+    _T_OF_LAST_UPPER_BEAM_CROSS = t_now
+    _signal_event()
 
 
 def _broken_lower_beam_callback(channel) -> None:
-    print("Broke lower beam!")
     global _T_OF_LAST_LOWER_BEAM_CROSS
-    _T_OF_LAST_LOWER_BEAM_CROSS = time.time()
+    t_now = time.monotonic()
+    if _T_OF_LAST_LOWER_BEAM_CROSS is not None and t_now - _T_OF_LAST_LOWER_BEAM_CROSS < _DEBOUNCE_S:
+        return  # Bounce
+    _log.debug("Broke lower beam!")
+    _T_OF_LAST_LOWER_BEAM_CROSS = t_now
+    _signal_event()
 
 
 def _sensor_hit_callback(channel) -> None:
-    print("Detected sensor hit!")
     global _T_OF_LAST_HIT
-    _T_OF_LAST_HIT = time.time()
+    t_now = time.monotonic()
+    if _T_OF_LAST_HIT is not None and t_now - _T_OF_LAST_HIT < _DEBOUNCE_S:
+        return  # Bounce
+    _log.debug("Detected sensor hit!")
+    _T_OF_LAST_HIT = t_now
+    _signal_event()
 
 
 class Interface:
     """Interface to Cielo IO."""
 
-    def __new__(cls):
-        """Make this a singleton by storing the one instance in the class itself."""
-        with _io_mod_lock:
-            if not hasattr(cls, "instance"):
-                cls.instance = super(Interface, cls).__new__(cls)
-            return cls.instance
-
     def __init__(self) -> None:
-        """Init interface to all IO pins."""
-        with _io_mod_lock:
-            if hasattr(self, "_setpoints"):
-                return  # Already initialized in another thread
-
-            GPIO.setmode(_PIN_NUMBERING_SYSTEM)
-
-            # LED setpoint and state setup. Vals are time to go off, if on.
-            self._setpoints: Mapping[LED, Optional[float]] = {
-                    color: None for color in LED}
-
-            for led in LED:  # LED enum values are pin numbers
-                GPIO.setup(led.value, GPIO.OUT)
-
-            # For timed but non-blocking set_on_for, a parallel thread checks to turn off
-            self._kill_par_thread = False
-            def _upkeep() -> None:
-                print("Starting upkeep thread.")
-                while True:
-                    if self._kill_par_thread:
-                        break
-                    self.upkeep()
-                    time.sleep(_PAR_THREAD_UPKEEP_PERIOD_S)
-            self._upkeep_thread = threading.Thread(name="upkeep_thread", target=_upkeep)
-            self._upkeep_thread.start()
-
-            # Init input pins
-            GPIO.setup(_UPPER_BEAM_SENSOR_INPUT_PIN, GPIO.IN, pull_up_down=GPIO.PUD_UP)
-            GPIO.add_event_detect(_UPPER_BEAM_SENSOR_INPUT_PIN,
-                GPIO.FALLING,  # Reading a false from the signal pin means beam broken
-                callback=_broken_upper_beam_callback,
-                bouncetime=_DEBOUNCE_MILLISECS)
-
-            GPIO.setup(_LOWER_BEAM_SENSOR_INPUT_PIN, GPIO.IN, pull_up_down=GPIO.PUD_UP)
-            GPIO.add_event_detect(_LOWER_BEAM_SENSOR_INPUT_PIN,
-                GPIO.FALLING,  # Reading a false from the signal pin means beam broken
-                callback=_broken_lower_beam_callback,
-                bouncetime=_DEBOUNCE_MILLISECS)
-
-            GPIO.setup(_TOUCH_SENSOR_INPUT_PIN, GPIO.IN, pull_up_down=GPIO.PUD_DOWN)
-            GPIO.add_event_detect(_TOUCH_SENSOR_INPUT_PIN,
-                GPIO.RISING,  # Going high on this input indicates a touch
-                callback=_sensor_hit_callback,
-                bouncetime=_DEBOUNCE_MILLISECS)
+        """Init interface to all IO pins. Use get_interface() rather than calling directly."""
+        GPIO.setmode(_PIN_NUMBERING_SYSTEM)
+
+        # For timed but non-blocking set_on_for, a timer (thread) per lit LED turns it
+        # off. Vals are the timer that will turn the LED off, if on.
+        self._timers: Dict[LED, Optional[threading.Timer]] = {
+                color: None for color in LED}
+
+        for led in LED:  # LED enum values are pin numbers
+            GPIO.setup(led.value, GPIO.OUT)
+
+        # Init input pins
+        GPIO.setup(_UPPER_BEAM_SENSOR_INPUT_PIN, GPIO.IN, pull_up_down=GPIO.PUD_UP)
+        GPIO.add_event_detect(_UPPER_BEAM_SENSOR_INPUT_PIN,
+            GPIO.FALLING,  # Reading a false from the signal pin means beam broken
+            callback=_broken_upper_beam_callback)
+
+        GPIO.setup(_LOWER_BEAM_SENSOR_INPUT_PIN, GPIO.IN, pull_up_down=GPIO.PUD_UP)
+        GPIO.add_event_detect(_LOWER_BEAM_SENSOR_INPUT_PIN,
+            GPIO.FALLING,  # Reading a false from the signal pin means beam broken
+            callback=_broken_lower_beam_callback)
+
+        GPIO.setup(_TOUCH_SENSOR_INPUT_PIN, GPIO.IN, pull_up_down=GPIO.PUD_DOWN)
+        GPIO.add_event_detect(_TOUCH_SENSOR_INPUT_PIN,
+            GPIO.RISING,  # Going high on this input indicates a touch
+            callback=_sensor_hit_callback)
 
     def set_on_for(self, n_seconds: float, color: LED) -> None:
-        """Set a particular LED on for N seconds (puts setpoint and turns on)."""
+        """Set a particular LED on for N seconds (turns on, and starts timer to turn off)."""
+        timer = threading.Timer(n_seconds, self._turn_off, args=(color,))
+        timer.daemon = True
         with _io_mod_lock:
-            self._setpoints[color] = time.time() + n_seconds
+            if self._timers[color]:
+                self._timers[color].cancel()
+            self._timers[color] = timer
             GPIO.output(color.value, _ON)
+            timer.start()
+
+    def set_on(self, color: LED) -> None:
+        """Set a particular LED on, until set_off (cancels any set_on_for timer)."""
+        self._set(color, _ON)
 
-    def upkeep(self) -> None:
-        """Upkeep IO (turn off as necessary)."""
-        # Make par thread
+    def set_off(self, color: LED) -> None:
+        """Set a particular LED off (cancels any set_on_for timer)."""
+        self._set(color, _OFF)
+
+    def _set(self, color: LED, value: int) -> None:
+        """Set an LED output, with no timer."""
+        with _io_mod_lock:
+            if self._timers[color]:
+                self._timers[color].cancel()
+                self._timers[color] = None
+            GPIO.output(color.value, value)
+
+    def _turn_off(self, color: LED) -> None:
+        """Turn an LED off when its timer (the calling thread) is up."""
         with _io_mod_lock:
-            for led, turn_off_time in self._setpoints.items():
-                if turn_off_time and turn_off_time <= time.time():
-                    GPIO.output(led.value, _OFF)
-                    self._setpoints[led] = None
+            # Timer may have been replaced (or cleared) while this was waiting on lock
+            if self._timers[color] is threading.current_thread():
+                GPIO.output(color.value, _OFF)
+                self._timers[color] = None
 
     def all_off(self) -> None:
-        """Turn all LEDs off (setpoint AND actual IO)."""
+        """Turn all LEDs off (timers AND actual IO)."""
         with _io_mod_lock:
             for led in LED:
                 GPIO.output(led.value, _OFF)
-                self._setpoints[led] = None
+                if self._timers[led]:
+                    self._timers[led].cancel()
+                self._timers[led] = None
 
     def get_latest_times(self) -> LatestTimes:
         """Get the latest times of various input sensor events."""
@@ -182,11 +225,26 @@ class Interface:
             upper_beam_cross=_T_OF_LAST_UPPER_BEAM_CROSS,
         )
 
+    def event_seq(self) -> int:
+        """Sequence number of latest input event, changes whenever get_latest_times does."""
+        # No lock needed, just a read
+        return _EVENT_SEQ
+
+    def event_fileno(self) -> int:
+        """File descriptor that is readable if any input events since clear_events()."""
+        return _EVENT_FD
+
+    def clear_events(self) -> None:
+        """Reset the event file descriptor (see event_fileno) to not readable."""
+        try:
+            os.eventfd_read(_EVENT_FD)
+        except BlockingIOError:
+            pass  # Nothing to clear
+
     def cleanup(self) -> None:
         """Clean up IO."""
         try:
             self.all_off()
-            self._kill_par_thread = True
         finally:
             try:
                 GPIO.cleanup()
@@ -194,3 +252,16 @@ class Interface:
                 print(f"Error {ex} cleaning up GPIO.")
                 pass  # Assume already cleaned up
 
+
+# The one instance of the interface, see get_interface
+_INTERFACE: Optional[Interface] = None
+
+
+def get_interface() -> Interface:
+    """Get the interface to Cielo IO, initializing it on first call."""
+    global _INTERFACE
+    if _INTERFACE is None:  # Only lock if might need to initialize
+        with _io_mod_lock:
+            if _INTERFACE is None:
+                _INTERFACE = Interface()
+    return _INTERFACE
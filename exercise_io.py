@@ -7,14 +7,14 @@ import time
 
 import inquirer
 
-from cielo_io import Interface as CieloIO, LED
+from cielo_io import LED, get_interface
 
 
 def main() -> None:
     # Basic stuff to exercise all the IO.
 
     print("Initializing...")
-    io_interf = CieloIO()
+    io_interf = get_interface()
     print("Done initializing Cielo IO.")
 
     # Get input on what to do
@@ -39,7 +39,7 @@ def main() -> None:
 
         case "LED Test":
             # Turn each on for 5s, waiting 2s between ons. They should then
-            # turn themselves off staggered, via the upkeep thread.
+            # turn themselves off staggered, via their timers.
             print("Orange first...")
             io_interf.set_on_for(5, LED.ORANGE)
             time.sleep(2)
@@ -65,4 +65,4 @@ if __name__ == "__main__":
     except KeyboardInterrupt:
         print("Caught Ctl-C, will still try cleaning up IO/parallel thread.")
     finally:
-        CieloIO().cleanup()
+        get_interface().cleanup()
@@ -3,11 +3,16 @@
 
 Run directly to exercise IO in test database.
 """
-import os
+import threading
 import time
+from contextlib import contextmanager
+from contextvars import ContextVar
 from dataclasses import dataclass, field
 from enum import Enum
-from typing import Final, List, Optional, Tuple
+from functools import lru_cache
+from itertools import accumulate, chain, groupby
+from operator import mul
+from typing import Final, Iterator, List, Optional, Tuple
 
 import mariadb
 
@@ -21,12 +26,15 @@ _CONN_INFO: Final = {
     "host": "localhost",
 }
 
+# Connections kept open for short-lived threads (e.g. web requests), see pooled_handler
+_POOL_SIZE: Final = 4
+
 # Game scoring parameters
 _INIT_AWARD_LOWER: Final = 2
 _INIT_AWARD_UPPER: Final = 5
 
 
-@dataclass
+@dataclass(slots=True)
 class Handler:
     """Database connection and cursor."""
 
@@ -42,7 +50,11 @@ class NetEvent(Enum):
     UPPER = 2
 
 
-@dataclass
+# Plain dict lookup, rather than going through the Enum machinery for NetEvent[name]
+_NAME_TO_NETEVENT: Final = {evt.name: evt for evt in NetEvent}
+
+
+@dataclass(slots=True)
 class GameState:
     """The events in the latest game if any, and latest score."""
 
@@ -55,12 +67,76 @@ class GameState:
     game_t_start: Optional[int] = None            # Start t of current game
 
 
+# Connection to the default database is made once per thread (context) and reused
+_HANDLER: ContextVar[Optional[Handler]] = ContextVar("cielo_db_handler", default=None)
+
+
 def get_handler(override_db: Optional[str] = None) -> Handler:
-    """Connect to the database and open cursor."""
+    """Get handler for the database, connecting and opening cursor if needed.
+
+    The connection to the default database is reused across calls in the same thread
+    (reconnecting if it has dropped). Overriding the database always connects fresh.
+    """
+    if not override_db:
+        handler = _HANDLER.get()
+        if handler:
+            handler.conn.ping()  # Reconnects if needed, see auto_reconnect below
+            return handler
+
     conn_info = {**_CONN_INFO, "database": override_db} if override_db else _CONN_INFO
     db_conn = mariadb.connect(**conn_info)
+    db_conn.auto_reconnect = True
     db_cur = db_conn.cursor()
-    return Handler(db_conn, db_cur)
+    handler = Handler(db_conn, db_cur)
+
+    if not override_db:
+        _HANDLER.set(handler)
+    return handler
+
+
+def drop_handler() -> None:
+    """Close and forget this thread's handler for the default database, if any.
+
+    For after a database error, so that the next get_handler connects fresh rather
+    than reusing a connection that may be broken.
+    """
+    handler = _HANDLER.get()
+    if handler:
+        _HANDLER.set(None)
+        try:
+            handler.conn.close()
+        except mariadb.Error:
+            pass  # Likely already broken, which is why it is being dropped
+
+
+# Created on first use of pooled_handler, under the lock
+_POOL: Optional[mariadb.ConnectionPool] = None
+_pool_lock = threading.Lock()
+
+
+@contextmanager
+def pooled_handler() -> Iterator[Handler]:
+    """Borrow a handler for the default database from a pool of open connections.
+
+    For threads that only live for a short while, e.g. one per web request, where the
+    per-thread reuse of get_handler would mean connecting every time. If the pool is
+    all in use, falls back to a fresh connection rather than waiting.
+    """
+    global _POOL
+    with _pool_lock:
+        if _POOL is None:
+            _POOL = mariadb.ConnectionPool(pool_name="cielo", pool_size=_POOL_SIZE, **_CONN_INFO)
+        try:
+            db_conn = _POOL.get_connection()
+        except mariadb.PoolError:
+            db_conn = None
+
+    if db_conn is None:
+        db_conn = mariadb.connect(**_CONN_INFO)
+    try:
+        yield Handler(db_conn, db_conn.cursor())
+    finally:
+        db_conn.close()  # Returns it to the pool, if from there
 
 
 # Query for information on latest game
@@ -70,29 +146,55 @@ WITH last_g AS (
     ORDER BY t_start DESC
     LIMIT 1
 )
-SELECT last_g.t_start, last_g.end_score, last_g.duration_seconds, events.kind
+SELECT last_g.t_start, last_g.end_score, last_g.duration_seconds, events.kind,
+    (SELECT MAX(end_score) FROM games) AS high_score  -- Same on every row
 FROM last_g
 -- Left join here allows us to see if game going even if no events yet
 LEFT JOIN events ON events.t_ref >= last_g.t_start
     AND events.t_ref < last_g.t_start + last_g.duration_seconds
+-- Scoring depends on order, and this is the order of the t_ref index range read
+ORDER BY events.t_ref
 """
 
 
+# Calls to get_state within this long of each other (e.g. bursts of polling) share
+# one database read, unless there has been a write from this process in between
+_STATE_TTL_S: Final = 0.1
+
+# Bumped on each write from this process, to invalidate the get_state cache
+_state_version = 0
+
+
 def get_state(handler: Optional[Handler] = None) -> GameState:
-    """Get the latest game state from database."""
-    state = GameState()
+    """Get the latest game state from database.
+
+    Without a handler, reads with one borrowed from the pool (see pooled_handler), and
+    the result may be cached for up to _STATE_TTL_S - treat as read-only.
+    """
+    if handler:
+        return _read_state(handler)
+    return _get_state_cached(int(time.monotonic() / _STATE_TTL_S), _state_version)
 
-    if not handler:
-        handler = get_handler()
+
+@lru_cache(maxsize=1)
+def _get_state_cached(ttl_hash: int, version: int) -> GameState:
+    """Read the state with a pooled handler, cached by args (only used as key)."""
+    with pooled_handler() as handler:
+        return _read_state(handler)
+
+
+def _read_state(handler: Handler) -> GameState:
+    """Read the latest game state from database."""
+    state = GameState()
 
     handler.cur.execute(_LATEST_GAME_Q)
 
     t_now = time.time()
-    for g_t_start, g_end_score, g_dur_s, evt_kind in handler.cur:
+    for g_t_start, g_end_score, g_dur_s, evt_kind, high_score in handler.cur:
         # No events in the most recent game is possible, in which case
         # we get start/score/dur but no event due to LEFT join above
         if evt_kind is not None:
-            state.events.append(NetEvent[evt_kind])
+            state.events.append(_NAME_TO_NETEVENT[evt_kind])
 
         # These get re-asserted each iteration >0, but no harm...
         state.game_t_start = g_t_start
@@ -100,19 +202,30 @@ def get_state(handler: Optional[Handler] = None) -> GameState:
         if t_left > 0:
             state.time_remaining_s = t_left
         state.latest_score = g_end_score
+        state.high_score = high_score if high_score is not None else 0
 
     # If any games so far
     if state.game_t_start:
         # Fill in the awards and current score (updates games table if needed)
         _fill_score_and_awards(handler, state)
 
-        # Get high score
-        handler.cur.execute("SELECT MAX(end_score) FROM games")
-        state.high_score = handler.cur.fetchone()[0]
+        # High score was read before any update above, current game may now beat it
+        state.high_score = max(state.high_score, state.latest_score)
 
     return state
 
 
+# Factor by which each beam cross event multiplies the awards (see below)
+_AWARD_FACTORS: Final = {
+    NetEvent.LOWER: _INIT_AWARD_LOWER,
+    NetEvent.UPPER: _INIT_AWARD_UPPER,
+}
+
+
+def _is_hit(event: NetEvent) -> bool:
+    return event == NetEvent.HIT
+
+
 def _fill_score_and_awards(handler: Handler, state: GameState) -> None:
     """Fill the current game score and awards.
 
@@ -120,55 +233,79 @@ def _fill_score_and_awards(handler: Handler, state: GameState) -> None:
     with values from the database.
     """
 
+    # Since the last HIT (which resets awards), each beam cross multiplies both awards
+    # by a factor, and scores the factor times the product of the factors before it
+    # (lower: _INIT_AWARD_LOWER * product, upper: _INIT_AWARD_UPPER * product).
+    # So per run of beam crosses between HITs, score comes from prefix products.
     current_g_score = 0
-    for event in state.events:
-        if event == NetEvent.LOWER:
-            # You get points equal to the award for lower beam cross
-            current_g_score += state.award_lower
-            # Plus your next awards go up by factor of _INIT_AWARD_LOWER
-            state.award_lower *= _INIT_AWARD_LOWER
-            state.award_upper *= _INIT_AWARD_LOWER
-        elif event == NetEvent.UPPER:
-            # You get points equal to the award for upper beam cross
-            current_g_score += state.award_upper
-            # Plus your next awards go up by factor of _INIT_AWARD_UPPER (even more)
-            state.award_lower *= _INIT_AWARD_UPPER
-            state.award_upper *= _INIT_AWARD_UPPER
-        elif event == NetEvent.HIT:
+    multiplier = 1  # Product of factors since last HIT
+    for is_hit, run in groupby(state.events, key=_is_hit):
+        if is_hit:
             # You "lose the benefit of your streak" if you hit - reset awards
-            state.award_lower = _INIT_AWARD_LOWER
-            state.award_upper = _INIT_AWARD_UPPER
+            multiplier = 1
+            continue
+        factors = [_AWARD_FACTORS[event] for event in run]
+        prefix_products = list(accumulate(factors, mul, initial=1))
+        current_g_score += sum(map(mul, factors, prefix_products))
+        multiplier = prefix_products[-1]
+
+    state.award_lower = _INIT_AWARD_LOWER * multiplier
+    state.award_upper = _INIT_AWARD_UPPER * multiplier
 
     # Update in database if the value doesn't match that read from games tbl
     if current_g_score != state.latest_score:
-        handler.cur.execute(f"UPDATE games SET end_score = {current_g_score} "
-                            f"WHERE t_start = {state.game_t_start}")
+        handler.cur.execute("UPDATE games SET end_score = ? WHERE t_start = ?",
+                            (current_g_score, state.game_t_start))
         handler.conn.commit()
         state.latest_score = current_g_score
 
     state.latest_score = current_g_score
 
 
+def _invalidate_state() -> None:
+    """Make sure the next get_state reads from the database."""
+    global _state_version
+    _state_version += 1
+
+
 def start_new_game(handler: Optional[Handler] = None) -> None:
     """Start a new game."""
-    if not handler:
-        handler = get_handler()
+    handler = handler or get_handler()
 
     # Now start the new game
     handler.cur.execute("INSERT INTO games (t_start, duration_seconds) "
-                        f"VALUES (UNIX_TIMESTAMP(), 60)")
+                        "VALUES (UNIX_TIMESTAMP(), 60)")
     handler.conn.commit()
+    _invalidate_state()
+
 
+# Events are inserted with one multi-row statement per (up to) this many. Each row is
+# a few dozen bytes, so this keeps statements far under the server's max_allowed_packet.
+_MAX_ROWS_PER_INSERT: Final = 1000
 
-def store_event(handler: Optional[Handler],
-                event_name: str, event_tstamp: int) -> None:
+
+@lru_cache(maxsize=32)
+def _insert_events_q(n_rows: int) -> str:
+    """Statement to insert n_rows events, values bound (so cached per row count)."""
+    return "INSERT INTO events (kind, t_ref) VALUES " + ", ".join(["(?, ?)"] * n_rows)
+
+
+def store_event(event_name: str, event_tstamp: int,
+                handler: Optional[Handler] = None) -> None:
     """Store an event in the database."""
-    if not handler:
-        handler = get_handler()
+    store_events([(event_name, event_tstamp)], handler)
+
+
+def store_events(events: List[Tuple[str, int]],
+                 handler: Optional[Handler] = None) -> None:
+    """Store several (event name, timestamp) events in the database, one commit."""
+    handler = handler or get_handler()
 
-    handler.cur.execute("INSERT INTO events (kind, t_ref)"
-                        f"VALUES ('{event_name}', {event_tstamp})")
+    for i_start in range(0, len(events), _MAX_ROWS_PER_INSERT):
+        rows = events[i_start:i_start + _MAX_ROWS_PER_INSERT]
+        handler.cur.execute(_insert_events_q(len(rows)), tuple(chain.from_iterable(rows)))
     handler.conn.commit()
+    _invalidate_state()
 
 
 if __name__ == "__main__":
@@ -182,14 +319,14 @@ if __name__ == "__main__":
     print("Okay wait a sec...")
     time.sleep(1)
     print("Now record a low...")
-    store_event(handler, NetEvent.LOWER.name, int(time.time()))
+    store_event(NetEvent.LOWER.name, int(time.time()), handler)
     print("Now state is", get_state(handler))
     print("Now wait again and record an upper...")
     time.sleep(0.5)
-    store_event(handler, NetEvent.UPPER.name, int(time.time()))
+    store_event(NetEvent.UPPER.name, int(time.time()), handler)
     print("Now state is", get_state(handler))
     time.sleep(0.5)
     print("Now a hit...")
-    store_event(handler, NetEvent.HIT.name, int(time.time()))
+    store_event(NetEvent.HIT.name, int(time.time()), handler)
     print("Final state is", get_state(handler))
 
@@ -1,20 +1,23 @@
 #!/usr/bin/env python3
 """Process to run and populate game-level events in database."""
 
+import logging
+import logging.handlers
+import queue
+import select
+import threading
 import time
-import traceback
-from dataclasses import asdict
-from typing import Final, Optional, Tuple
+from dataclasses import dataclass
+from typing import Dict, Final, List, Optional, Tuple
 
 import click
+import mariadb
 
-from cielo_io import Interface as CieloIO, LatestTimes, LED
-from models import Handler, NetEvent, get_handler, store_event
+from cielo_io import Interface as CieloIO, LatestTimes, LED, get_interface, to_epoch
+from models import NetEvent, drop_handler, get_handler, get_state, store_events
+import state_cache
 
 
-# How often to look at latest times and update LEDs and DB accordingly
-_CHECK_PERIOD_S: Final = 0.2
-
 # How long to "blur" - i.e., wait at least this long after event to
 # assume that it is all that is going to happen for a given throw.
 # In other words, consider how if the ball goes through the low beam,
@@ -25,6 +28,10 @@ _CHECK_PERIOD_S: Final = 0.2
 # aren't about to supercede a given one. This is that "wait time."
 _EVENT_WINDOW_S: Final = 1.0
 
+# If an event was not ready to process, look again this long after its window is up
+# (not exactly at it, so that float rounding can't make it just short)
+_WINDOW_SLACK_S: Final = 0.01
+
 # How to indicate a net event visually to player
 _NET_EVENT_LED_SIGNIFIERS: Final = {
     NetEvent.HIT: LED.RED,
@@ -35,104 +42,305 @@ _NET_EVENT_LED_SIGNIFIERS: Final = {
 # How long to leave the LED on for an event
 _LED_DUR_S: Final = 2
 
+# Defaults for how events are batched into inserts, see InsertCfg
+_DEFAULT_QUERY_BUFFER_SIZE: Final = 32
+_DEFAULT_QUERY_FLUSH_TIME_S: Final = 0.5
+
+# Events wait for the database writer thread in a queue of at most this many. If
+# the database falls this far behind, new events are dropped rather than blocking.
+_MAX_QUEUED_EVENTS: Final = 1000
+
+# Log records are buffered and written this many at a time, or as soon as one is at
+# least INFO (so only debug output, e.g. every input event, can be held back)
+_LOG_BUFFER_RECORDS: Final = 64
+
+_log = logging.getLogger(__name__)
+
+# When not storing events, the writer thread still publishes the game state (see
+# state_cache) this often (well within state_cache.MAX_AGE_S), e.g. for games ending
+_STATE_HEARTBEAT_S: Final = 1.0
+
+
+@dataclass(slots=True)
+class InsertCfg:
+    """How events get batched into database inserts (see store_queued_events).
+
+    A batch is stored (one commit) once it has max_batch_size events or about
+    max_batch_bytes of values, or flush_interval after its first event, whichever is
+    first. Failed stores are retried up to max_retries times, waiting retry_backoff_s
+    before the first retry and doubling each time after.
+    """
+
+    max_batch_size: int = _DEFAULT_QUERY_BUFFER_SIZE
+    max_batch_bytes: int = 4096
+    flush_interval: float = _DEFAULT_QUERY_FLUSH_TIME_S
+    max_retries: int = 5
+    retry_backoff_s: float = 0.1
+
+
+def get_latest_tstamp(times: LatestTimes) -> Optional[float]:
+    """Get the latest of the times, None if nothing has happened."""
+    candidates = (times.hit, times.lower_beam_cross, times.upper_beam_cross)
+    return max((t for t in candidates if t is not None), default=None)
+
 
 def get_net_event(times: LatestTimes, ref_time: float) -> Optional[Tuple[NetEvent, float]]:
     """Decide which thing is most relevant (see above event window example).
 
-    So looking from (_EVENT_WINDOW_S * 2) ago until _EVENT_WINDOW_S ago.
+    So once the latest thing is at least _EVENT_WINDOW_S ago, looking at everything
+    within _EVENT_WINDOW_S before it.
 
     Arguments:
         times: The latest times things happened.
-        ref_time: The reference time of "now" (stamp from time.time())
+        ref_time: The reference time of "now" (stamp from time.monotonic())
 
     Returns:
-        The relevant net event, and the timestamp at which occurred
+        The relevant net event, and the (monotonic) timestamp at which occurred
     """
-    nonnull_ts = [t for t in [times.hit, times.lower_beam_cross, times.upper_beam_cross]  if t]
-    if len(nonnull_ts) == 0:
+    latest_thing_tstamp = get_latest_tstamp(times)
+    if latest_thing_tstamp is None:
         raise ValueError("Only call get_net_event if something has happened.")
 
-    latest_thing_tstamp = max(nonnull_ts)
-    t_ago_s = ref_time - latest_thing_tstamp
-    if t_ago_s < _EVENT_WINDOW_S:
+    if latest_thing_tstamp > ref_time - _EVENT_WINDOW_S:
         # It hasn't been long enough to conclude what happened... let dust settle
         return None
 
+    # Only things after this are part of the net event. Relative to the latest thing
+    # rather than ref_time, so however late this is called, the latest thing counts.
+    cutoff = latest_thing_tstamp - _EVENT_WINDOW_S
+
     # If it hit, doesn't matter if other beams crossed (prioritize hit)
-    if times.hit and ref_time - times.hit < _EVENT_WINDOW_S * 2:
+    if times.hit is not None and times.hit > cutoff:
         return (NetEvent.HIT, latest_thing_tstamp)
     # Next prioritize upper beam - went through lower to get to the upper, no hit
-    if times.upper_beam_cross and ref_time - times.upper_beam_cross < _EVENT_WINDOW_S * 2:
+    if times.upper_beam_cross is not None and times.upper_beam_cross > cutoff:
         return (NetEvent.UPPER, latest_thing_tstamp)
-    # Lastly check for lower beam
-    if times.lower_beam_cross and ref_time - times.lower_beam_cross < _EVENT_WINDOW_S * 2:
-        return (NetEvent.LOWER, latest_thing_tstamp)
-
-    # This should generally not happen... didn't call frequently enough
-    raise RuntimeError("In get_net_event, didn't find anything to handle.")
+    # Lastly lower beam - must be, since the latest thing is one of the three
+    return (NetEvent.LOWER, latest_thing_tstamp)
 
 
-def handle_cycle(db_handler: Handler,
+def handle_cycle(event_queue: queue.Queue,
                  io_interf: CieloIO,
-                 times: LatestTimes) -> LatestTimes:
+                 led_off_deadlines: Dict[LED, float],
+                 processed_seq: int,
+                 now: float) -> int:
     """Handle one cycle of the read/process loop.
 
     Arguments:
-        db_cur: The database cursor
+        event_queue: Queue of events (name, epoch time) to store, net events get put
         io_interf: The IO interface
-        times: The (previous-cycle) read of the latest times of beam hits/contacts
+        led_off_deadlines: When to turn lit LEDs off, LEDs lit for events get added
+        processed_seq: Input event sequence number (see Interface.event_seq) processed up to
+        now: The time of this cycle (stamp from time.monotonic())
 
     Returns:
-        A new read of the latest times of any beam hits/contacts (vals may be same).
+        The input event sequence number now processed up to (may be same).
     """
-    new_read_of_times = io_interf.get_latest_times()
-    now = time.time()
+    # Read before times, so anything happening in between is not counted as processed
+    seq = io_interf.event_seq()
 
-    if new_read_of_times != times:
+    if seq != processed_seq:
 
-        print("Something unprocessed happened, checking for net event criteria...")
-        maybe_evt_info = get_net_event(new_read_of_times, now)
+        _log.debug("Something unprocessed happened, checking for net event criteria...")
+        maybe_evt_info = get_net_event(io_interf.get_latest_times(), now)
         if maybe_evt_info:
             relevant_event, event_tstamp = maybe_evt_info
-            # Light an LED based on the event
-            io_interf.set_on_for(_LED_DUR_S, _NET_EVENT_LED_SIGNIFIERS[relevant_event])
-
-            # Record the event in the database for use in webapp
-            store_event(db_handler, relevant_event.name, int(event_tstamp))
-
-            print("Processed the event, report times as current (processed) state")
-            return new_read_of_times
+            # Light an LED based on the event (the loop turns it off when due)
+            led = _NET_EVENT_LED_SIGNIFIERS[relevant_event]
+            io_interf.set_on(led)
+            led_off_deadlines[led] = now + _LED_DUR_S
+
+            # Queue the event for the database, for use in webapp
+            try:
+                event_queue.put_nowait((relevant_event.name, int(to_epoch(event_tstamp))))
+            except queue.Full:
+                _log.warning("Database writer too far behind, dropped %s event.",
+                             relevant_event.name)
+
+            _log.debug("Processed %s event, report sequence number as processed",
+                       relevant_event.name)
+            return seq
         else:
-            print("Change but not ready to 'sign off' on event, return old state.")
-            return times
+            _log.debug("Change but not ready to 'sign off' on event, return old sequence number.")
+            return processed_seq
     else:
-        # No change, doesn't matter which we return...
-        return times
+        # No change, the common case - no need to even read the times
+        return processed_seq
 
 
-@click.command("populate_events")
-def populate_events() -> None:
-    """Entrypoint for script to populate events in DB."""
-
-    print("Initializing IO...")
-    io_interf = CieloIO()
+def store_queued_events(event_queue: queue.Queue, cfg: InsertCfg) -> None:
+    """Store events from the queue in batches, until None is queued (to stop).
 
-    print("IO ready. Connecting to database...")
-    db_handler = get_handler()
+    Meant to run in its own thread, so database latency never holds up the IO loop.
+    Uses its own connection (see get_handler), replaced on errors (see _store_batch).
+    Also publishes the game state after storing, and every _STATE_HEARTBEAT_S if idle.
 
-    print("Connected. Starting measurement loop.")
-    times = LatestTimes()
-    loop_iter = 0
-    while True:
-        # Just a debug print that something is running
-        loop_iter += 1
-        if loop_iter % 50 == 0:
-            print(f"Loop iteration {loop_iter}")
+    Arguments:
+        event_queue: Queue of events (name, epoch time) to store
+        cfg: How to batch the events into inserts
+    """
+    stopping = False
+    while not stopping:
+        try:
+            event = event_queue.get(timeout=_STATE_HEARTBEAT_S)
+        except queue.Empty:
+            _publish_state()
+            continue
+        if event is None:
+            break
+
+        batch = [event]
+        batch_bytes = _event_bytes(event)
+        flush_at = time.monotonic() + cfg.flush_interval
+        while len(batch) < cfg.max_batch_size and batch_bytes < cfg.max_batch_bytes:
+            try:
+                event = event_queue.get(timeout=max(0.0, flush_at - time.monotonic()))
+            except queue.Empty:
+                break
+            if event is None:
+                stopping = True  # Still store what we have first
+                break
+            batch.append(event)
+            batch_bytes += _event_bytes(event)
+
+        _store_batch(batch, cfg)
+        _publish_state()
+
+
+def _event_bytes(event: Tuple[str, int]) -> int:
+    """Rough size of an event's values in an insert (name, plus 8 for the int)."""
+    return len(event[0]) + 8
+
+
+def _store_batch(batch: List[Tuple[str, int]], cfg: InsertCfg) -> None:
+    """Store a batch of events, retrying with exponential backoff on database errors.
+
+    Each retry is on a fresh connection, in case the error was the connection dropping.
+    """
+    backoff_s = cfg.retry_backoff_s
+    for attempt in range(cfg.max_retries + 1):
+        try:
+            store_events(batch, get_handler())
+            return
+        except mariadb.Error as ex:
+            drop_handler()
+            if attempt == cfg.max_retries:
+                _log.error("Error %s storing events, giving up on %s of them.", ex, len(batch))
+                return
+            _log.warning("Error %s storing events, retrying in %s seconds...", ex, backoff_s)
+            time.sleep(backoff_s)
+            backoff_s *= 2
+        except Exception:
+            # Not the database, so retrying won't help - but don't kill the writer thread
+            _log.exception("Unexpected error storing events, giving up on %s of them.",
+                           len(batch))
+            return
+
+
+def _publish_state() -> None:
+    """Publish the game state for the web service (see state_cache), if possible.
+
+    Errors are logged rather than raised, so they can't kill the writer thread.
+    """
+    try:
+        state_cache.publish(get_state(get_handler()))
+    except mariadb.Error as ex:
+        drop_handler()  # Connect fresh next time
+        _log.warning("Error %s reading game state, not publishing it.", ex)
+    except Exception:
+        _log.exception("Unexpected error publishing game state.")
+
+
+def _configure_logging(debug: bool) -> None:
+    """Log to stderr, buffering records to write them in batches (see _LOG_BUFFER_RECORDS)."""
+    stream_handler = logging.StreamHandler()
+    stream_handler.setFormatter(logging.Formatter("%(asctime)s %(levelname)s %(message)s"))
+    buffer_handler = logging.handlers.MemoryHandler(capacity=_LOG_BUFFER_RECORDS,
+                                                    flushLevel=logging.INFO,
+                                                    target=stream_handler)
+    root_logger = logging.getLogger()
+    root_logger.addHandler(buffer_handler)
+    root_logger.setLevel(logging.DEBUG if debug else logging.INFO)
 
-        # All the action is in here
-        times = handle_cycle(db_handler, io_interf, times)
 
-        time.sleep(_CHECK_PERIOD_S)
+@click.command("populate_events")
+@click.option("--debug/--no-debug",
+              default=False,
+              help="Whether to log debug info (e.g. every input event)")
+@click.option("--query-buffer-size",
+              default=_DEFAULT_QUERY_BUFFER_SIZE,
+              type=int,
+              help="Store events in the database once this many are pending")
+@click.option("--query-flush-time",
+              default=_DEFAULT_QUERY_FLUSH_TIME_S,
+              type=float,
+              help="Max seconds to hold an event before storing it in the database")
+def populate_events(debug: bool, query_buffer_size: int, query_flush_time: float) -> None:
+    """Entrypoint for script to populate events in DB."""
+    _configure_logging(debug)
+
+    _log.info("Initializing IO...")
+    io_interf = get_interface()
+
+    _log.info("IO ready. Starting database writer...")
+    event_queue: queue.Queue = queue.Queue(maxsize=_MAX_QUEUED_EVENTS)
+    insert_cfg = InsertCfg(max_batch_size=query_buffer_size, flush_interval=query_flush_time)
+    writer = threading.Thread(name="db_writer_thread",
+                              target=store_queued_events,
+                              args=(event_queue, insert_cfg),
+                              daemon=True)
+    writer.start()
+
+    _log.info("Database writer started. Starting measurement loop.")
+    # Block until the IO signals an input event, rather than polling
+    epoll = select.epoll()
+    epoll.register(io_interf.event_fileno(), select.EPOLLIN)
+
+    processed_seq = io_interf.event_seq()  # Input events handled so far
+    check_deadline: Optional[float] = None  # When to next check for a net event
+    led_off_deadlines: Dict[LED, float] = {}  # When to turn off each lit LED
+    try:
+        while True:
+            # Sleep until the next thing is due, or an input event
+            deadlines = list(led_off_deadlines.values())
+            if check_deadline is not None:
+                deadlines.append(check_deadline)
+            timeout = max(0.0, min(deadlines) - time.monotonic()) if deadlines else None
+            input_events = epoll.poll(timeout)
+            if input_events:
+                io_interf.clear_events()
+            now = time.monotonic()
+
+            if input_events:
+                # Something happened - (re)start the wait for the dust to settle
+                check_deadline = now + _EVENT_WINDOW_S
+
+            for led in [led for led, off_at in led_off_deadlines.items() if off_at <= now]:
+                io_interf.set_off(led)
+                del led_off_deadlines[led]
+
+            if check_deadline is None or now < check_deadline:
+                continue
+
+            # All the action is in here
+            processed_seq = handle_cycle(event_queue, io_interf, led_off_deadlines,
+                                         processed_seq, now)
+
+            # If something happened but wasn't ready to process, look again as soon as
+            # the dust has settled after it
+            if io_interf.event_seq() != processed_seq:
+                latest_tstamp = get_latest_tstamp(io_interf.get_latest_times())
+                check_deadline = latest_tstamp + _EVENT_WINDOW_S + _WINDOW_SLACK_S
+            else:
+                check_deadline = None
+    finally:
+        # Don't lose anything already processed - writer stores it all before stopping
+        try:
+            event_queue.put_nowait(None)
+        except queue.Full:
+            _log.warning("Database writer too far behind, some events will not be stored.")
+        else:
+            writer.join()
 
 
 if __name__ == "__main__":
@@ -140,12 +348,10 @@ if __name__ == "__main__":
     try:
         populate_events()
     except Exception as ex:
-        print(f"Caught exception {ex}, traceback:")
-        print(traceback.format_exc())
-        print("Still cleaning up IO...")
+        _log.exception("Caught exception %s, still cleaning up IO...", ex)
     except SystemExit as _:
         # Click throws this on Ctl-C, catch separately as inherits from BaseException
-        print(f"Cleaning up IO...")
+        _log.info("Cleaning up IO...")
     finally:
-        CieloIO().cleanup()
-        print("Done cleaning up.")
+        get_interface().cleanup()
+        _log.info("Done cleaning up.")
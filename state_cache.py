@@ -0,0 +1,77 @@
+"""Shared snapshot of the latest game state, so reading it doesn't need the database.
+
+The populate_events process publishes the state whenever it stores events (and on a
+heartbeat in between), and the web service publishes it after starting a new game.
+The web service then serves state from here, only going to the database itself if
+there is no recent snapshot (e.g. populate_events isn't running).
+
+The snapshot is a small JSON file in shared memory, replaced atomically on publish.
+"""
+import json
+import os
+import tempfile
+import time
+from dataclasses import asdict
+from typing import Final, Optional
+
+from models import GameState, NetEvent
+
+
+_STATE_PATH: Final = "/dev/shm/cielo_state.json"
+
+# Snapshots older than this are not trusted - publishers should beat well within it
+MAX_AGE_S: Final = 3.0
+
+
+def publish(state: GameState) -> None:
+    """Publish a snapshot of the game state."""
+    snapshot = asdict(state)
+    snapshot["events"] = [evt.name for evt in state.events]
+    snapshot["t_published"] = time.time()
+
+    # Write elsewhere then move into place, so readers never see a partial file. The
+    # temp file is unique to this call, as publishers may be in concurrent threads.
+    tmp_fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(_STATE_PATH))
+    try:
+        os.fchmod(tmp_fd, 0o644)  # mkstemp makes it private, but readers may be other users
+        with os.fdopen(tmp_fd, "w") as tmp_file:
+            json.dump(snapshot, tmp_file)
+        os.replace(tmp_path, _STATE_PATH)
+    except BaseException:
+        os.unlink(tmp_path)
+        raise
+
+
+def published_at() -> Optional[int]:
+    """When the latest snapshot was published (file mtime in ns), None if never.
+
+    Much cheaper than load, for checking whether there is anything new to load.
+    """
+    try:
+        return os.stat(_STATE_PATH).st_mtime_ns
+    except OSError:
+        return None
+
+
+def load() -> Optional[GameState]:
+    """Load the latest snapshot of the game state, None if no recent enough one."""
+    try:
+        with open(_STATE_PATH) as state_file:
+            snapshot = json.load(state_file)
+    except (OSError, ValueError):
+        return None  # Not published yet, or unreadable - either way, no snapshot
+
+    age_s = time.time() - snapshot.pop("t_published")
+    if age_s > MAX_AGE_S:
+        return None
+
+    snapshot["events"] = [NetEvent[name] for name in snapshot["events"]]
+    state = GameState(**snapshot)
+
+    # The game clock has kept running since publish
+    if state.time_remaining_s is not None:
+        state.time_remaining_s -= age_s
+        if state.time_remaining_s <= 0:
+            state.time_remaining_s = None
+
+    return state
@@ -1,8 +1,9 @@
 /* Event handing for Cielo app.
  *
  * 1. Call new game API when new game button clicked,
- * 2. Update the state (high score, feed, summary) on load and
- *    timer and also after new game initiated
+ * 2. Update the state (high score, feed, summary) as the server pushes it,
+ *    or if the browser can't take pushes, on load and timer and also after
+ *    new game initiated
  */
 
 
@@ -10,24 +11,37 @@ $(".cielonewgame").click(function() {
   $.ajax({
     url: "/newgame",
     success: function(response) {
-      update_state();
+      if (!window.EventSource) {
+        update_state();
+      }
     }
   });
 })
 
 
+function show_state(data) {
+  $(".cielofeed").html(data.feed);
+  $(".cielogamesummary").html(data.summary);
+  $(".cielohighscore").html(data.highscore);
+}
+
+
 function update_state() {
   $.ajax({
     url: "/state",
-    success: function(data) {
-      $(".cielofeed").html(data.feed);
-      $(".cielogamesummary").html(data.summary);
-      $(".cielohighscore").html(data.highscore);
-    }
+    success: show_state
   });
 }
 
 
-$(window).on('load', update_state);
+if (window.EventSource) {
+  // Reconnects by itself if the stream drops
+  var state_source = new EventSource("/events");
+  state_source.onmessage = function(event) {
+    show_state(JSON.parse(event.data));
+  };
+} else {
+  $(window).on('load', update_state);
 
-setInterval(update_state, 3000);
+  setInterval(update_state, 3000);
+}
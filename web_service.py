@@ -2,17 +2,37 @@
 """The web service for the Cielo game."""
 
 import logging
-from typing import Any, Mapping, Optional
+import time
+from typing import Final, Iterator, Optional, Tuple
 
 import click
-import mariadb
-from flask import Flask, render_template
+import orjson
+from flask import Flask, Response, render_template
 
 import models
+import state_cache
 
 
 app = Flask("cielo")
 
+# Feed template, loaded and compiled once (it needs none of the request context)
+_FEED_TEMPLATE: Final = app.jinja_env.get_template("feed.html")
+
+# Last rendered feed, keyed by (game start, number of events). Events only ever get
+# added to a game, so if the key is unchanged the feed is too.
+_feed_cache: Optional[Tuple[Tuple[Optional[int], int], str]] = None
+
+# How often an /events stream checks whether the state snapshot was republished
+_EVENTS_CHECK_S: Final = 0.25
+
+# If the snapshot hasn't been republished in this long (e.g. populate_events isn't
+# running), an /events stream reads the state again anyway (from the database)
+_EVENTS_FALLBACK_S: Final = 3.0
+
+# An /events stream sends something (a comment, if no new state) at least this often.
+# Closed connections are only noticed on writing, so this is what ends their streams.
+_EVENTS_KEEPALIVE_S: Final = 5.0
+
 
 @app.route("/")
 def index() -> str:
@@ -23,12 +43,14 @@ def index() -> str:
 @app.route("/newgame")
 def newgame() -> str:
     """Start a new game. No response really needed... but okay."""
-    models.start_new_game()
+    with models.pooled_handler() as handler:
+        models.start_new_game(handler)
+        state_cache.publish(models.get_state(handler))
     return "Okay."
 
 
 @app.route("/state")
-def state() -> Mapping[str, Any]:
+def state() -> Response:
     """Get the state of the game - the feed, summary, and high score.
 
     Returns:
@@ -38,18 +60,72 @@ def state() -> Mapping[str, Any]:
             "highscore": "High Score: 123"
         }
     """
-    state = models.get_state()
+    # State changes constantly, so nothing along the way should cache it
+    return Response(_state_payload(_get_state()), mimetype="application/json",
+                    headers={"Cache-Control": "no-store"})
+
 
+@app.route("/events")
+def events() -> Response:
+    """Server-sent event stream of the state of the game (as for /state).
+
+    A state is sent on connecting, then again whenever it changes.
+    """
+    def stream() -> Iterator[bytes]:
+        last_published = None
+        last_payload = None
+        reread_at = 0.0
+        keepalive_at = 0.0
+        while True:
+            published = state_cache.published_at()
+            if published != last_published or time.monotonic() >= reread_at:
+                last_published = published
+                reread_at = time.monotonic() + _EVENTS_FALLBACK_S
+                payload = _state_payload(_get_state())
+                if payload != last_payload:
+                    last_payload = payload
+                    keepalive_at = time.monotonic() + _EVENTS_KEEPALIVE_S
+                    yield b"data: " + payload + b"\n\n"
+            if time.monotonic() >= keepalive_at:
+                keepalive_at = time.monotonic() + _EVENTS_KEEPALIVE_S
+                yield b": keepalive\n\n"
+            time.sleep(_EVENTS_CHECK_S)
+
+    return Response(stream(), mimetype="text/event-stream",
+                    headers={"Cache-Control": "no-store"})
+
+
+def _get_state() -> models.GameState:
+    """Get the state of the game, from the snapshot if there's a recent one."""
+    # Snapshot is kept up to date by populate_events, only query if it isn't running.
+    # Then concurrent requests (and /events streams) share reads, see models.get_state.
+    return state_cache.load() or models.get_state()
+
+
+def _state_payload(state: models.GameState) -> bytes:
+    """The state of the game as JSON, for the front end (see state for format)."""
     summary = f"Score: {state.latest_score}"
     if state.time_remaining_s:
         summary += f" <br/> {int(state.time_remaining_s)} seconds left"
         summary += f" <br/> Current Awards: {state.award_lower} / {state.award_upper}"
 
-    return {
+    # Sent often, so serialize with orjson rather than Flask's (stdlib) json
+    return orjson.dumps({
         "summary": summary,
-        "feed": render_template("feed.html", events=[evt.name for evt in state.events]),
+        "feed": _render_feed(state),
         "highscore": f"High Score: {state.high_score}",
-    }
+    })
+
+
+def _render_feed(state: models.GameState) -> str:
+    """Render the feed for the game state, reusing the last render if no new events."""
+    global _feed_cache
+    key = (state.game_t_start, len(state.events))
+    cached = _feed_cache  # Local ref, the global may be replaced by another request thread
+    if cached is None or cached[0] != key:
+        cached = (key, _FEED_TEMPLATE.render(events=[evt.name for evt in state.events]))
+        _feed_cache = cached
+    return cached[1]
 
 
 @click.command()